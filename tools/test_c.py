@@ -1,13 +1,36 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import argparse
+import copy
+import hashlib
+import logging
 import os
 import os.path as osp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from itertools import chain
+from multiprocessing.util import Finalize
 
+import mmengine
 from mmengine.config import Config, ConfigDict, DictAction
-from mmengine.registry import RUNNERS
-from mmengine.runner import Runner
+from mmengine.fileio import LocalBackend, get_file_backend
+from mmengine.logging import print_log
+from mmengine.utils import import_modules_from_strings
 
-from mmdet3d.utils import replace_ceph_backend
+CORRUPTIONS = ('gaussian_noise', 'shot_noise', 'impulse_noise', 'defocus_blur',
+               'glass_blur', 'motion_blur', 'zoom_blur', 'snow', 'frost',
+               'fog', 'brightness', 'contrast', 'elastic_transform',
+               'pixelate', 'jpeg_compression')
+# corruptions that also come with corrupted point clouds, which are only
+# available at the moderate severity
+PTS_CORRUPTIONS = frozenset({'fog', 'snow', 'motion_blur'})
+PTS_SEVERITY = 2
+
+# KITTI metrics collected for every corruption
+REPORTED_METRICS = frozenset({
+    'Car_3D_AP40_moderate_strict', 'Pedestrian_3D_AP40_moderate_loose',
+    'Cyclist_3D_AP40_moderate_loose', 'Car_2D_AP40_moderate_strict',
+    'Pedestrian_2D_AP40_moderate_loose', 'Cyclist_2D_AP40_moderate_loose'
+})
 
 
 # TODO: support fuse_conv_bn and format_only
@@ -27,7 +50,8 @@ def parse_args():
         '--show-dir',
         help='directory where painted images will be saved. '
         'If specified, it will be automatically saved '
-        'to the work_dir/timestamp/show_dir')
+        'to the work_dir/timestamp/show_dir, with one sub directory per '
+        'corruption when testing corruptions')
     parser.add_argument(
         '--score-thr', type=float, default=0.1, help='bbox score threshold')
     parser.add_argument(
@@ -64,9 +88,43 @@ def parse_args():
     parser.add_argument(
         '--test_c', action='store_true', help='test corruption')
     parser.add_argument(
-        '--log', default='log', type=str, help='save result')
+        '--log',
+        default='log',
+        type=str,
+        help='name of the result file saved to work_dir/corruption_logs')
+    parser.add_argument(
+        '--corruptions',
+        type=lambda s: s.split(','),
+        default=None,
+        help='comma separated corruptions to test, e.g. gaussian_noise,fog. '
+        'All corruptions are tested by default')
+    parser.add_argument(
+        '--severity',
+        type=int,
+        choices=range(5),
+        default=2,
+        help='severity index of the corrupted images, which are read from '
+        'val_c/{corruption}/{severity + 1}. The point clouds of fog, snow '
+        'and motion_blur are always the moderate ones (severity 2)')
+    parser.add_argument(
+        '--parallel',
+        type=int,
+        default=1,
+        help='number of worker processes (one per GPU) used to test '
+        'corruptions in parallel')
+    parser.add_argument(
+        '--force-recompute',
+        action='store_true',
+        help='test all corruptions again instead of reusing the metrics '
+        'cached in work_dir/.metric_cache for the same checkpoint and config')
 
     args = parser.parse_args()
+    if args.corruptions is not None:
+        unknown = set(args.corruptions) - set(CORRUPTIONS)
+        if unknown:
+            parser.error(f'unknown corruptions: {sorted(unknown)}')
+    if args.parallel > 1 and args.launcher != 'none':
+        parser.error('--parallel is only supported with --launcher none')
     if 'LOCAL_RANK' not in os.environ:
         os.environ['LOCAL_RANK'] = str(args.local_rank)
     return args
@@ -101,14 +159,247 @@ def trigger_visualization_hook(cfg, args):
     return cfg
 
 
+def checkpoint_hash(filename):
+    """Tag a checkpoint by its size and the md5 of its first 1MB.
+
+    Returns None if the checkpoint is not a local file, e.g. a URL or an
+    ``s3://`` path, in which case its metrics are not cached.
+    """
+    if not isinstance(get_file_backend(filename), LocalBackend) \
+            or not osp.isfile(filename):
+        return None
+    with open(filename, 'rb') as f:
+        md5 = hashlib.md5(f.read(1 << 20))
+    md5.update(str(osp.getsize(filename)).encode())
+    return md5.hexdigest()
+
+
+def save_metrics(metric_dict, filename):
+    """Dump metrics atomically, so that an interrupted run never leaves a
+    truncated cache file behind for the next run to resume from."""
+    tmp_file = f'{filename}.{os.getpid()}.tmp'
+    mmengine.dump(metric_dict, tmp_file, file_format='json')
+    os.replace(tmp_file, filename)
+
+
+def build_runner(cfg):
+    """Build the runner from config."""
+    from mmengine.registry import RUNNERS
+    from mmengine.runner import Runner
+
+    if 'runner_type' not in cfg:
+        # build the default runner
+        runner = Runner.from_cfg(cfg)
+    else:
+        # build customized runner from the registry
+        # if 'runner_type' is set in the cfg
+        runner = RUNNERS.build(cfg)
+    return runner
+
+
+def corruption_prefix(base_prefix, corruption, severity):
+    """Get the data prefix of a corruption from the clean data prefix."""
+    data_prefix = dict(base_prefix)
+    data_prefix['img'] = f'val_c/{corruption}/{severity+1}'
+    if corruption in PTS_CORRUPTIONS:
+        data_prefix['pts'] = f'val_c/{corruption}/moderate/velodyne'
+    return data_prefix
+
+
+def extract_metrics(corruption, metric_dict):
+    """Pick the moderate AP40 metrics reported for a corruption."""
+    results = dict()
+    for key, value in metric_dict.items():
+        metric = key.rsplit('/', 1)[-1]
+        if metric in REPORTED_METRICS:
+            results[corruption + '/' + metric] = value
+    return results
+
+
+def test_corruption(runner, cfg, corruption, data_prefix):
+    """Test the model on one corruption, reusing ``runner`` if it is built.
+
+    This follows ``Runner.test()``, except that the ``before_run`` hooks only
+    run for the first corruption and the ``after_run`` hooks, which close the
+    visualizer, are left to :func:`finish_runner` at the end of the sweep.
+    """
+    cfg.test_dataloader.dataset.data_prefix = data_prefix
+    if runner is None:
+        runner = build_runner(cfg)
+        if runner.test_loop is None:
+            raise RuntimeError(
+                '`test_loop` should not be None when testing corruptions. '
+                'Please provide `test_dataloader`, `test_cfg` and '
+                '`test_evaluator` in the config.')
+        runner.call_hook('before_run')
+        runner.load_or_resume()
+    else:
+        # only the data changes between corruptions, so keep the model,
+        # hooks and loaded weights and rebuild just the test dataloader
+        runner.test_loop.dataloader = runner.build_dataloader(
+            cfg.test_dataloader,
+            seed=runner.seed,
+            diff_rank_seed=runner._randomness_cfg.get('diff_rank_seed', False))
+    set_corruption_outputs(runner, cfg, corruption)
+    return runner, runner.test_loop.run()
+
+
+def set_corruption_outputs(runner, cfg, corruption):
+    """Name the per-run outputs of a reused runner after the corruption.
+
+    All corruptions tested by one runner share its log dir, so the metrics
+    json of the logger hook and the images painted for ``--show-dir`` get a
+    per-corruption name instead of overwriting each other.
+    """
+    from mmengine.hooks import LoggerHook
+
+    show_dir = cfg.default_hooks.get('visualization', {}).get('test_out_dir')
+    for hook in runner.hooks:
+        if isinstance(hook, LoggerHook):
+            hook.json_log_path = f'{runner.timestamp}_{corruption}.json'
+        elif show_dir is not None and hasattr(hook, 'test_out_dir'):
+            hook.test_out_dir = osp.join(show_dir, corruption)
+
+
+def finish_runner(runner):
+    """Call the ``after_run`` hooks of a runner once its sweep is done."""
+    if runner is not None:
+        runner.call_hook('after_run')
+
+
+def limit_threads(cfg, num_procs=1):
+    """Share the CPU cores between the test processes and their dataloader
+    workers to avoid oversubscription."""
+    import torch
+
+    if hasattr(os, 'sched_getaffinity'):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count()
+    num_workers = max(1, cfg.test_dataloader.get('num_workers', 0))
+    torch.set_num_threads(max(1, num_cpus // (num_workers * num_procs)))
+
+
+# state of a worker process in the parallel corruption sweep
+_worker = dict()
+
+
+def init_worker(cfg, gpu_ids, num_procs):
+    """Bind a worker process to one GPU before CUDA is initialized."""
+    device = gpu_ids.get()
+    os.environ['CUDA_VISIBLE_DEVICES'] = device
+    limit_threads(cfg, num_procs)
+    # workers started in the same second would share the timestamped log
+    # dir of the runner and overwrite each other's logs
+    cfg.work_dir = osp.join(cfg.work_dir, f'gpu{device}')
+    # spawned workers only get the pickled config, so the custom modules
+    # imported by ``Config.fromfile`` in the parent are imported again here
+    if cfg.get('custom_imports', None):
+        import_modules_from_strings(**cfg['custom_imports'])
+    _worker['cfg'] = cfg
+    _worker['runner'] = None
+    # run when the pool shuts the worker down
+    Finalize(None, _finish_worker, exitpriority=10)
+
+
+def _finish_worker():
+    finish_runner(_worker['runner'])
+
+
+def run_worker(corruption, data_prefix):
+    """Test one corruption with the runner owned by the worker process."""
+    _worker['runner'], metric_dict = test_corruption(_worker['runner'],
+                                                     _worker['cfg'],
+                                                     corruption, data_prefix)
+    return corruption, metric_dict
+
+
+def sweep_corruptions(cfg, corruptions, severity, num_procs=1):
+    """Test the model on each corruption and yield the metrics.
+
+    With ``num_procs > 1`` the corruptions are tested by a pool of worker
+    processes with one GPU each, and the metrics are yielded in the order
+    the corruptions finish.
+    """
+    base_prefix = copy.deepcopy(cfg.test_dataloader.dataset.data_prefix)
+    # each test dataloader is iterated once and its workers hold their own
+    # copy of the dataset, so they cannot be reused for the next corruption.
+    # Without persistent workers they exit as soon as the data is loaded
+    # instead of idling while the metrics are computed.
+    cfg.test_dataloader.persistent_workers = False
+    if num_procs > 1:
+        import torch.multiprocessing as mp
+
+        # each worker owns one GPU and consumes corruptions from the pool
+        # queue, so the sweep scales with the number of GPUs
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        if visible:
+            devices = visible.split(',')[:num_procs]
+        else:
+            devices = [str(i) for i in range(num_procs)]
+        ctx = mp.get_context('spawn')
+        gpu_ids = ctx.Queue()
+        for device in devices:
+            gpu_ids.put(device)
+        with ProcessPoolExecutor(
+                max_workers=num_procs,
+                mp_context=ctx,
+                initializer=init_worker,
+                initargs=(cfg, gpu_ids, num_procs)) as executor:
+            futures = {
+                executor.submit(
+                    run_worker, corruption,
+                    corruption_prefix(base_prefix, corruption, severity)):
+                corruption
+                for corruption in corruptions
+            }
+            # a failed corruption must not discard the others, so keep
+            # yielding the finished ones and raise once all of them are done
+            failed = dict()
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed[futures[future]] = e
+                    print_log(
+                        f'{futures[future]} failed: {e!r}',
+                        logger='current',
+                        level=logging.ERROR)
+                    continue
+                yield result
+            if failed:
+                error = next(iter(failed.values()))
+                raise RuntimeError(
+                    f'Testing failed for {sorted(failed)}') from error
+    else:
+        limit_threads(cfg)
+        runner = None
+        try:
+            for corruption in corruptions:
+                data_prefix = corruption_prefix(base_prefix, corruption,
+                                                severity)
+                runner, metric_dict = test_corruption(runner, cfg, corruption,
+                                                      data_prefix)
+                yield corruption, metric_dict
+        finally:
+            finish_runner(runner)
+
+
 def main():
+    # torch, mmengine.runner and mmdet3d are imported where they are used,
+    # so that ``--help`` and argument errors return without loading them
     args = parse_args()
+    # keep the dataloader and worker processes single-threaded, the thread
+    # count of each test process is set by ``limit_threads``
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    os.environ.setdefault('MKL_NUM_THREADS', '1')
 
     # load config
     cfg = Config.fromfile(args.config)
 
     # TODO: We will unify the ceph support approach with other OpenMMLab repos
     if args.ceph:
+        from mmdet3d.utils import replace_ceph_backend
         cfg = replace_ceph_backend(cfg)
 
     cfg.launcher = args.launcher
@@ -138,60 +429,105 @@ def main():
         cfg.model = ConfigDict(**cfg.tta_model, module=cfg.model)
 
     if args.test_c:
-        corruptions = ['gaussian_noise', 'shot_noise', 'impulse_noise',
-                       'defocus_blur', 'glass_blur', 'motion_blur',  'zoom_blur',
-                       'snow', 'frost', 'fog', 'brightness',
-                       'contrast',  'elastic_transform', 'pixelate', 'jpeg_compression']
+        corruptions = args.corruptions or CORRUPTIONS
+        severity = args.severity
+        mixed = sorted(PTS_CORRUPTIONS.intersection(corruptions))
+        if severity != PTS_SEVERITY and mixed:
+            print_log(
+                f'{mixed} are tested with images of severity {severity} but '
+                f'point clouds of severity {PTS_SEVERITY} (moderate)',
+                logger='current',
+                level=logging.WARNING)
+        results = dict()
         total_dict = dict()
+
+        from mmengine.dist import (broadcast_object_list, init_dist,
+                                   is_distributed, is_main_process)
+
+        # every rank gets the metrics, but only the main process writes the
+        # result and cache files. The runner does not init the process group
+        # again if it already exists.
+        if cfg.launcher != 'none' and not is_distributed():
+            dist_cfg = cfg.get('env_cfg', {}).get('dist_cfg', {})
+            init_dist(cfg.launcher, **dist_cfg)
+        is_main = is_main_process()
+
+        # open the result file before testing so that an unwritable path
+        # fails right away instead of after the whole sweep
+        log_dir = osp.join(cfg.work_dir, 'corruption_logs')
+        log_file = osp.join(log_dir, f'{args.log}.txt')
+        if is_main:
+            mmengine.mkdir_or_exist(log_dir)
+            log = open(log_file, 'w', buffering=1)
+        else:
+            log = nullcontext()
+
+        # metrics of corruptions already tested with the same checkpoint,
+        # config (after overrides and TTA) and severity are reused unless
+        # --force-recompute is set. They are saved as soon as each corruption
+        # finishes, so an interrupted sweep resumes from the last finished
+        # corruption.
+        cache_dir = osp.join(cfg.work_dir, '.metric_cache')
+        ckpt_hash = checkpoint_hash(args.checkpoint)
+        if ckpt_hash is not None:
+            cfg_hash = hashlib.md5(cfg.pretty_text.encode()).hexdigest()
+            cache_prefix = osp.join(cache_dir, f'{ckpt_hash}_{cfg_hash}')
+            cache_files = {
+                corruption: f'{cache_prefix}_{corruption}_{severity}.json'
+                for corruption in corruptions
+            }
+            if is_main:
+                mmengine.mkdir_or_exist(cache_dir)
+        else:
+            cache_files = dict()
+        cached = dict()
+        if is_main and not args.force_recompute:
+            for corruption, cache_file in cache_files.items():
+                if osp.isfile(cache_file):
+                    cached[corruption] = mmengine.load(cache_file)
+        # work_dir may not be shared between nodes, so all ranks take the
+        # cached metrics of the main process and test the same corruptions
+        objs = [cached]
+        broadcast_object_list(objs)
+        cached = objs[0]
+        todo = [c for c in corruptions if c not in cached]
+
+        if args.parallel > 1:
+            import torch
+            num_procs = min(args.parallel, torch.cuda.device_count(),
+                            len(todo))
+        else:
+            num_procs = 1
+        with log as f:
+            # write the metrics of each corruption as soon as it finishes,
+            # the file is rewritten in order once all of them are done
+            for corruption, metric_dict in chain(
+                    cached.items(),
+                    sweep_corruptions(cfg, todo, severity, num_procs)):
+                print_log(f'{corruption}: {metric_dict}', logger='current')
+                results[corruption] = extract_metrics(corruption, metric_dict)
+                if not is_main:
+                    continue
+                if corruption in cache_files and corruption not in cached:
+                    save_metrics(metric_dict, cache_files[corruption])
+                for key, value in results[corruption].items():
+                    f.write(f'{key}: {value}\n')
+
+        # corruptions finish out of order with --parallel and cached ones
+        # come first, so the summary and the final result file follow the
+        # order of ``corruptions``
         for corruption in corruptions:
-            # for severity in range(5):
-            severity = 2
-            cfg.test_dataloader.dataset.data_prefix['img'] = f'val_c/{corruption}/{severity+1}'
-            if corruption in ['fog', 'snow', 'motion_blur']:
-                cfg.test_dataloader.dataset.data_prefix['pts'] = f'val_c/{corruption}/moderate/velodyne'
-
-            # build the runner from config
-            if 'runner_type' not in cfg:
-                # build the default runner
-                runner = Runner.from_cfg(cfg)
-            else:
-                # build customized runner from the registry
-                # if 'runner_type' is set in the cfg
-                runner = RUNNERS.build(cfg)
-
-            # start testing
-            metric_dict = runner.test()
-            print(metric_dict)
-
-            # key = f'{corruption}/AP40_Moderate_0.7_3D_Car'
-            # total_dict[key] = metric_dict['Kitti metric/pred_instances_3d/KITTI/Car_3D_AP40_moderate_strict']
-
-            for key in metric_dict.keys():
-                if 'Car_3D_AP40_moderate_strict' in key:
-                    new_key = f"{corruption}/{key.split('/')[-1]}"
-                    total_dict[new_key] = metric_dict[key]
-                elif 'Pedestrian_3D_AP40_moderate_loose' in key:
-                    new_key = f"{corruption}/{key.split('/')[-1]}"
-                    total_dict[new_key] = metric_dict[key]
-                elif 'Cyclist_3D_AP40_moderate_loose' in key:
-                    new_key = f"{corruption}/{key.split('/')[-1]}"
-                    total_dict[new_key] = metric_dict[key]
-                elif 'Car_2D_AP40_moderate_strict' in key:
-                    new_key = f"{corruption}/{key.split('/')[-1]}"
-                    total_dict[new_key] = metric_dict[key]
-                elif 'Pedestrian_2D_AP40_moderate_loose' in key:
-                    new_key = f"{corruption}/{key.split('/')[-1]}"
-                    total_dict[new_key] = metric_dict[key]
-                elif 'Cyclist_2D_AP40_moderate_loose' in key:
-                    new_key = f"{corruption}/{key.split('/')[-1]}"
-                    total_dict[new_key] = metric_dict[key]
-
-        for key, value in total_dict.items():
-            print(f'{key}: {value}')
-
-        with open(f'/ws/external/work_dirs/{args.log}.txt', 'w') as f:
+            total_dict.update(results[corruption])
+        if is_main:
+            tmp_file = f'{log_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                for key, value in total_dict.items():
+                    f.write(f'{key}: {value}\n')
+            os.replace(tmp_file, log_file)
+
             for key, value in total_dict.items():
-                f.write(f'{key}: {value}\n')
+                print(f'{key}: {value}')
+
 
 if __name__ == '__main__':
     main()